@@ -2,10 +2,11 @@ from __future__ import annotations
 
 import argparse
 import logging
-import re
+import os
 import shutil
 import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Iterable, Optional
@@ -13,14 +14,21 @@ from typing import Iterable, Optional
 from .argparse_helper import ArgparseMixin, arg, mutually_exclusive, yes_no_arg
 from .zmk import (
     CompilationItem,
+    LazyCmdline,
+    check_call_prefixed,
     check_west_setup,
+    inputs_digest,
+    inputs_fingerprint,
     run_west_setup,
     run_west_update,
+    toolchain_id,
     west_build_command,
 )
 
 logger = logging.getLogger(__name__)
 
+INPUTS_STAMP = "zmk_build.stamp"
+
 
 def main(argv: Optional[list[str]] = None):
     parser = argparse.ArgumentParser(
@@ -58,69 +66,194 @@ def main(argv: Optional[list[str]] = None):
     extra_cmake_args = [f"-DCONFIG_{k}={v}" for k, v in FW_OPTS]
     extra_cmake_args += ["-Wno-dev"]
 
-    extra_args: list[str] = []
-    for unknown_arg in unknown_args:
-        if unknown_arg.startswith("-D"):
-            extra_cmake_args.append(unknown_arg)
-        else:
-            extra_args.append(unknown_arg)
+    # Zephyr picks up `ccache` by itself (`USE_CCACHE`), `sccache` has to be
+    # set as compiler launcher explicitly
+    build_env: Optional[dict[str, str]] = None
+    if MISC.no_ccache:
+        extra_cmake_args.append("-DUSE_CCACHE=0")
+    else:
+        if launcher := shutil.which("sccache"):
+            logger.debug("using `%s` as compiler launcher", launcher)
+            extra_cmake_args += [
+                "-DUSE_CCACHE=0",
+                f"-DCMAKE_C_COMPILER_LAUNCHER={launcher}",
+                f"-DCMAKE_CXX_COMPILER_LAUNCHER={launcher}",
+            ]
+        # paths under the ZMK directory are hashed relative to the build directory,
+        # and the compiler is checked by content so that entries survive a
+        # reinstalled toolchain; hits still need the same build directory path
+        # (and its generated headers), so the two halves of a split build don't
+        # share entries
+        build_env = {
+            "CCACHE_BASEDIR": str(DIRS.zmk.resolve()),
+            "CCACHE_COMPILERCHECK": "content",
+            **os.environ,
+        }
+
+    user_cmake_args = [a for a in unknown_args if a.startswith("-D")]
+    extra_cmake_args += user_cmake_args
+    extra_args = [a for a in unknown_args if not a.startswith("-D")]
 
     shield_dirs = [
         DIRS.zmk_config / "boards" / "shields",
         DIRS.zmk_app / "boards" / "shields",
     ]
+    items: list[CompilationItem] = []
     for item in CompilationItem.Find(
         SHIELD_BOARD.board, SHIELD_BOARD.primary_shield, shield_dirs
     ):
         if ARTEFACTS.left_only and item.shield_side != "left":
-            logger.info(f'not building `{item.shield_side}` side (`left` only)')
+            logger.info("not building `%s` side (`left` only)", item.shield_side)
             continue
         if ARTEFACTS.right_only and item.shield_side != "right":
-            logger.info(f'not building `{item.shield_side}` side (`right` only)')
+            logger.info("not building `%s` side (`right` only)", item.shield_side)
             continue
-
-        build_dir = DIRS.build / join([item.zmk_shield, item.zmk_board], "-")
-        tmp_bin_name = item.filename(alias=ARTEFACTS.name)
-        final_bin_name = item.filename(tag=str(FW_OPTS), alias=ARTEFACTS.name)
-
-        shields = (
-            [item.zmk_shield, *SHIELD_BOARD.secondary_shields]
-            if item.zmk_shield
-            else []
-        )
-        west_build_cmd = west_build_command(
-            item.zmk_board,
-            shields,
-            app_dir=DIRS.zmk_app,
-            zmk_config=DIRS.zmk_config if DIRS.zmk_config.is_dir() else None,
-            build_dir=build_dir,
-            bin_name=tmp_bin_name,
-            pristine=MISC.pristine,
-            extra_args=extra_args,
-            extra_cmake_args=extra_cmake_args,
-        )
-        action = "would run" if MISC.dry_run else "run"
-        logger.info(f"{action} `{subprocess.list2cmdline(west_build_cmd)}`")
-        if not MISC.dry_run:
+        items.append(item)
+
+    # builds are independent (separate build directories and artefact names)
+    # so they can run concurrently; keep dry-runs sequential for a readable log
+    if MISC.dry_run or len(items) < 2:
+        max_workers = 1
+    else:
+        max_workers = max(1, min(MISC.jobs or os.cpu_count() or 1, len(items)))
+    fw_tag = str(FW_OPTS)
+    zmk_config = DIRS.zmk_config if DIRS.zmk_config.is_dir() else None
+    # shared by all items; don't run git/west and hash zmk-config just to print commands
+    digest = None
+    if not (MISC.dry_run or MISC.no_reuse):
+        if path_args := [a for a in user_cmake_args if has_path_value(a, DIRS.zmk_app)]:
+            logger.debug(
+                "`%s` refers to a path, not reusing previous builds", path_args[0]
+            )
+        else:
+            digest = inputs_digest(DIRS.zmk, zmk_config)
+    exit_code = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                build_item,
+                item,
+                SHIELD_BOARD,
+                DIRS,
+                zmk_config,
+                digest,
+                fw_tag,
+                ARTEFACTS,
+                MISC,
+                extra_args,
+                extra_cmake_args,
+                env=build_env,
+                label=item_label(item) if max_workers > 1 else None,
+            ): item
+            for item in items
+        }
+        for future in as_completed(futures):
             try:
-                subprocess.check_call(west_build_cmd, cwd=DIRS.zmk_app, text=True)
+                future.result()
             except subprocess.CalledProcessError as e:
-                logger.error("build failed")
-                return e.returncode
+                logger.error("build failed (`%s`)", item_label(futures[future]))
+                exit_code = exit_code or e.returncode
+            except Exception as e:
+                logger.error("build failed (`%s`): %s", item_label(futures[future]), e)
+                exit_code = exit_code or 1
+
+    return exit_code
+
+
+def build_item(
+    item: CompilationItem,
+    shield_board: ShieldBoard,
+    dirs: Directories,
+    zmk_config: Optional[Path],
+    digest: Optional[str],
+    fw_tag: str,
+    artefacts: Artefacts,
+    misc: Misc,
+    extra_args: list[str],
+    extra_cmake_args: list[str],
+    env: Optional[dict[str, str]] = None,
+    label: Optional[str] = None,
+):
+    build_dir = dirs.build / join([item.zmk_shield, item.zmk_board], "-")
+    tmp_bin_name = item.filename(alias=artefacts.name)
+    final_bin_name = item.filename(tag=fw_tag, alias=artefacts.name)
+
+    shields = (
+        [item.zmk_shield, *shield_board.secondary_shields] if item.zmk_shield else []
+    )
+    west_build_cmd = west_build_command(
+        item.zmk_board,
+        shields,
+        app_dir=dirs.zmk_app,
+        zmk_config=zmk_config,
+        build_dir=build_dir,
+        bin_name=tmp_bin_name,
+        pristine=misc.pristine,
+        extra_args=extra_args,
+        extra_cmake_args=extra_cmake_args,
+    )
 
-        for ext in ARTEFACTS.extensions:
-            temp_output = build_dir / "zephyr" / f"{tmp_bin_name}.{ext}"
-            final_output = ARTEFACTS.directory / f"{final_bin_name}.{ext}"
+    zephyr_dir = build_dir / "zephyr"
+    temp_outputs = [
+        zephyr_dir / f"{tmp_bin_name}.{ext}" for ext in artefacts.extensions
+    ]
 
-            action = "would copy" if MISC.dry_run else "copy"
-            logger.info(f"{action} `{temp_output}` to `{final_output}`")
-            if not MISC.dry_run:
-                if temp_output.is_file():
-                    shutil.copy(temp_output, final_output)
-                else:
-                    logger.warning(f"`{temp_output}` is not a file")
+    build_id = (item.zmk_board, *shields, tmp_bin_name, *extra_args, *extra_cmake_args)
 
+    def fingerprint():
+        toolchain = toolchain_id(build_dir) if digest else None
+        return inputs_fingerprint(build_id, toolchain, digest) if toolchain else None
 
+    stamp = build_dir / INPUTS_STAMP
+    if (
+        digest
+        and not misc.pristine
+        and stamp.is_file()
+        and stamp.read_text() == fingerprint()
+        and all(temp_output.is_file() for temp_output in temp_outputs)
+    ):
+        logger.info("inputs unchanged, reuse previous build in `%s`", build_dir)
+    else:
+        action = "would run" if misc.dry_run else "run"
+        logger.info("%s `%s`", action, LazyCmdline(west_build_cmd))
+        if not misc.dry_run:
+            stamp.unlink(missing_ok=True)
+            if label:
+                check_call_prefixed(
+                    west_build_cmd, f"[{label}] ", cwd=dirs.zmk_app, env=env
+                )
+            else:
+                subprocess.check_call(
+                    west_build_cmd, cwd=dirs.zmk_app, env=env, text=True
+                )
+            if new_fingerprint := fingerprint():
+                stamp.write_text(new_fingerprint)
+
+    for ext, temp_output in zip(artefacts.extensions, temp_outputs):
+        final_output = artefacts.directory / f"{final_bin_name}.{ext}"
+
+        action = "would copy" if misc.dry_run else "copy"
+        logger.info("%s `%s` to `%s`", action, temp_output, final_output)
+        if not misc.dry_run:
+            if temp_output.is_file():
+                copy_file(temp_output, final_output)
+            else:
+                logger.warning("`%s` is not a file", temp_output)
+
+
+def has_path_value(cmake_arg: str, cwd: Path):
+    """whether a `-DNAME=VALUE` argument points to an existing file or directory,
+    whose contents the inputs digest doesn't cover"""
+    values = cmake_arg.partition("=")[2].split(";")
+    return any(value and (cwd / value).exists() for value in values)
+
+
+def item_label(item: CompilationItem):
+    return item.shield_side or item.zmk_shield or item.zmk_board
+
+
+# no `slots=True` (Python 3.10+) here: zmk_build runs under the build image's
+# `python3`, not the host's
 @dataclass(frozen=True)
 class ShieldBoard(ArgparseMixin):
     shields: list[str]
@@ -251,9 +384,17 @@ class FwOptions(ArgparseMixin):
             yield "ZMK_KEYBOARD_NAME", f'"{escaped_kb_name}"'
 
     def __bool__(self):
-        return any(self)
+        # same conditions as `__iter__`, without formatting any value
+        return (
+            any(b is not None for b in (self.logging, self.usb, self.ble))
+            or bool(self.max_bt)
+            or bool(self.kb_name)
+        )
 
     def __str__(self):
+        if not self:
+            return ""
+
         def parts():
             def yn(b: bool):
                 return "y" if b else "n"
@@ -267,7 +408,7 @@ class FwOptions(ArgparseMixin):
             if self.max_bt:
                 yield f"max-bt={self.max_bt}"
             if self.kb_name:
-                esc_kb_name = re.sub(r"[/\\]", "_", self.kb_name)
+                esc_kb_name = self.kb_name.replace("/", "_").replace("\\", "_")
                 yield f"name={esc_kb_name}"
 
         return ",".join(parts())
@@ -290,6 +431,9 @@ class FwOptions(ArgparseMixin):
 class Misc(ArgparseMixin):
     update_west: bool
     pristine: bool
+    no_reuse: bool
+    no_ccache: bool
+    jobs: Optional[int]
     dry_run: bool
     verbose: bool
 
@@ -305,6 +449,23 @@ class Misc(ArgparseMixin):
             action="store_true",
             help="clean build directories before starting",
         ),
+        no_reuse=arg(
+            "--no-reuse",
+            action="store_true",
+            help="always run `west build`, even if its inputs are unchanged",
+        ),
+        no_ccache=arg(
+            "--no-ccache",
+            action="store_true",
+            help="don't use ccache/sccache even if available",
+        ),
+        jobs=arg(
+            "-j",
+            "--jobs",
+            type=int,
+            metavar="N",
+            help="number of concurrent builds (default: one per CPU)",
+        ),
         dry_run=arg(
             "-n",
             "--dry-run",
@@ -315,8 +476,33 @@ class Misc(ArgparseMixin):
     )
 
 
+def copy_file(src: Path, dst: Path):
+    """copy contents only (no metadata), in-kernel with `copy_file_range`
+    (which can reflink on CoW filesystems) if possible"""
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            size = remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if not copied:
+                    break
+                remaining -= copied
+    except (AttributeError, OSError):
+        shutil.copyfile(src, dst)
+        return
+
+    if remaining and remaining == size:
+        # nothing copied, some filesystems don't support it for these files
+        shutil.copyfile(src, dst)
+    elif remaining:
+        raise OSError(
+            f"copy of `{src}` to `{dst}` stopped after "
+            f"{size - remaining} of {size} bytes"
+        )
+
+
 def join(parts: Iterable[Optional[str]], sep: str) -> str:
-    return sep.join(filter(None, parts))
+    return sep.join(p for p in parts if p)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,24 @@
 from __future__ import annotations
 
-import re
 from argparse import _ArgumentGroup  # type: ignore
 from argparse import ArgumentParser, FileType, Namespace
 from typing import Any, Callable, Dict, Iterable, Optional, Sequence, Tuple, TypeVar
 
 T = TypeVar("T")
 
+# argparse actions that take no value and reject a `metavar`
+NO_METAVAR_ACTIONS = frozenset(
+    {
+        "store_true",
+        "store_false",
+        "store_const",
+        "append_const",
+        "count",
+        "help",
+        "version",
+    }
+)
+
 
 class arg:
     def __init__(
@@ -42,9 +54,7 @@ class arg:
         self.parse = _parse or (lambda x: x)
         self.dump = _dump or str
 
-    def kwargs(self, dest: str):
         all_kwargs = dict(
-            dest=dest,
             nargs=self.nargs,
             const=self.const,
             default=self.default,
@@ -53,14 +63,19 @@ class arg:
             choices=self.choices,
             required=self.required,
             help=self.help,
-            metavar=self.metavar,
         )
-        kwargs = {k: v for k, v in all_kwargs.items() if v is not None}
-
-        if not self.metavar:
-            kwargs["metavar"] = dest.upper()
+        self._base_kwargs = {k: v for k, v in all_kwargs.items() if v is not None}
 
-        return kwargs
+    def kwargs(self, dest: str, name: Optional[str] = None):
+        """`add_argument` keyword arguments; default metavar is `name` (or `dest`)
+        uppercased"""
+        if self.action in NO_METAVAR_ACTIONS:
+            return {**self._base_kwargs, "dest": dest}
+        return {
+            **self._base_kwargs,
+            "dest": dest,
+            "metavar": self.metavar or (name or dest).upper(),
+        }
 
 
 class mutually_exclusive(Dict[str, arg]):
@@ -71,6 +86,31 @@ class ArgparseMixin:
     _argparse: dict[str, arg] | Sequence[dict[str, arg]]
     _argparse_prefix: str = ""
     _argparse_suffix: str = ""
+    _argparse_groups_cache: tuple[dict[str, arg], ...] = ()
+    _argparse_args_cache: tuple[tuple[str, arg], ...] = ()
+    _argparse_dests_cache: tuple[str, ...] = ()
+    _argparse_option_strings_cache: dict[str, tuple[str, ...]] = {}
+
+    def __init_subclass__(cls, **kwargs: Any):
+        super().__init_subclass__(**kwargs)
+        # `_argparse` is static, normalize and flatten it once per class
+        if hasattr(cls, "_argparse"):
+            if isinstance(cls._argparse, dict):
+                cls._argparse_groups_cache = (cls._argparse,)
+            else:
+                cls._argparse_groups_cache = tuple(cls._argparse)
+            cls._argparse_args_cache = tuple(
+                item for group in cls._argparse_groups_cache for item in group.items()
+            )
+            cls._argparse_dests_cache = tuple(
+                cls._prefix_dest(attr_name) for attr_name, _ in cls._argparse_args_cache
+            )
+            cls._argparse_option_strings_cache = {
+                attr_name: tuple(
+                    cls._prefix_option_string(s) for s in arg.option_strings
+                )
+                for attr_name, arg in cls._argparse_args_cache
+            }
 
     @classmethod
     def From_args(cls, args: list[str]):
@@ -83,8 +123,10 @@ class ArgparseMixin:
     def From_parsed_args(cls, parsed_args: Namespace):
         return cls(
             **{
-                k: _v.parse(getattr(parsed_args, cls._prefix_dest(k)))
-                for k, _v in cls._argparse_args()
+                k: _v.parse(getattr(parsed_args, dest))
+                for (k, _v), dest in zip(
+                    cls._argparse_args(), cls._argparse_dests_cache
+                )
             }
         )
 
@@ -105,6 +147,8 @@ class ArgparseMixin:
         if group:
             parser = parser.add_argument_group(title=group)
 
+        # prefixed dests are cached in the same (flattened) order as the groups' items
+        dests = iter(cls._argparse_dests_cache)
         for argparse_group in cls._argparse_groups():
             if isinstance(argparse_group, mutually_exclusive):
                 add_to = parser.add_mutually_exclusive_group()
@@ -112,38 +156,23 @@ class ArgparseMixin:
                 add_to = parser
 
             for attr_name, arg in argparse_group.items():
-                args = arg.option_strings
-                if cls._argparse_prefix or cls._argparse_suffix:
-                    args = [
-                        re.sub(
-                            r"^--(.+)",
-                            rf"--{cls._argparse_prefix}\1{cls._argparse_suffix}",
-                            arg,
-                        )
-                        for arg in args
-                    ]
-                kwargs = arg.kwargs(dest=attr_name)
-                kwargs["dest"] = cls._prefix_dest(attr_name)
-                try:
-                    add_to.add_argument(*args, **kwargs) #type: ignore
-                except TypeError as e:
-                    if re.search(r"unexpected.*metavar", str(e)):
-                        kwargs.pop("metavar")
-                        add_to.add_argument(*args, **kwargs) #type: ignore
-                    else:
-                        raise
+                args = cls._argparse_option_strings_cache[attr_name]
+                kwargs = arg.kwargs(dest=next(dests), name=attr_name)
+                add_to.add_argument(*args, **kwargs) #type: ignore
 
     @classmethod
     def _argparse_groups(cls) -> Sequence[dict[str, arg]]:
-        if isinstance(cls._argparse, dict):
-            return [cls._argparse]
-        else:
-            return cls._argparse
+        return cls._argparse_groups_cache
 
     @classmethod
     def _argparse_args(cls) -> Iterable[tuple[str, arg]]:
-        for group in cls._argparse_groups():
-            yield from group.items()
+        return cls._argparse_args_cache
+
+    @classmethod
+    def _prefix_option_string(cls, option_string: str):
+        if option_string.startswith("--"):
+            return f"--{cls._argparse_prefix}{option_string[2:]}{cls._argparse_suffix}"
+        return option_string
 
     @classmethod
     def _prefix_dest(cls, dest: str):
@@ -153,7 +182,7 @@ class ArgparseMixin:
 def yes_no_arg(*option_strings: str, help: str):
     def yn_to_bool(s: Optional[str]):
         if s is not None:
-            return s.lower().startswith("y")
+            return s[:1] in ("y", "Y")
 
     def yn_from_bool(b: bool):
         return "yes" if b else "no"
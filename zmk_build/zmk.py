@@ -1,14 +1,20 @@
 from dataclasses import dataclass
+from functools import cached_property
+import hashlib
 import logging
 import re
 import subprocess
+import sys
 from pathlib import Path
-from typing import Iterable, Iterator, List, Optional, Union
+from typing import Iterable, Iterator, List, Mapping, Optional, Union
 
 logger = logging.getLogger(__name__)
 
+BOARD_NAME_RE = re.compile(r"config BOARD_(\w+)")
+BOARD_TYPE_RE = re.compile(r"CONFIG_(\w+)_MPU")
 
-@dataclass
+
+@dataclass(frozen=True)
 class CompilationItem:
     zmk_board: str
     """valid zmk board name, eg. `nice_nano_v2`"""
@@ -17,7 +23,7 @@ class CompilationItem:
     shield_side: Optional[str]
     """side name for split shields, `left` or `right`"""
 
-    @property
+    @cached_property
     def zmk_shield(self):
         """valid zmk shield name, with `_side` prefix for split shields, 
         eg. `corne_left`"""
@@ -55,9 +61,8 @@ class CompilationItem:
 
 def guess_board_name(board_dir: Path):
     if board_dir.is_dir():
-        for line in open(board_dir / "Kconfig.board"):
-            if m := re.search(r"config BOARD_(\w+)", line):
-                return str(m.group(1)).lower()
+        if m := BOARD_NAME_RE.search((board_dir / "Kconfig.board").read_text()):
+            return str(m.group(1)).lower()
     raise ValueError("could not guess board name")
 
 
@@ -65,9 +70,8 @@ def guess_board_type(board_dir: Path):
     if board_dir.is_dir():
         for child in board_dir.glob("*_defconfig"):
             if child.is_file():
-                for line in open(child):
-                    if m := re.search(r"CONFIG_(\w+)_MPU", line):
-                        return str(m.group(1)).lower()
+                if m := BOARD_TYPE_RE.search(child.read_text()):
+                    return str(m.group(1)).lower()
     raise ValueError("could not guess board type")
 
 
@@ -80,14 +84,12 @@ def guess_shield_name(shield_dir: Path):
 
 
 def guess_split_shield_sides(shield_dir: Path, shield_name: str):
-    def find_all():
-        defconfig = shield_dir / "Kconfig.defconfig"
-        if defconfig.is_file():
-            for line in open(defconfig):
-                for m in re.findall(rf"SHIELD_{shield_name}_(\w+)", line, flags=re.I):
-                    yield str(m).lower()
+    side_re = re.compile(rf"SHIELD_{re.escape(shield_name)}_(\w+)", flags=re.I)
 
-    return set(find_all())
+    defconfig = shield_dir / "Kconfig.defconfig"
+    if defconfig.is_file():
+        return {str(m).lower() for m in side_re.findall(defconfig.read_text())}
+    return set()
 
 
 def find_dir(*candidates: Path) -> Optional[Path]:
@@ -96,28 +98,32 @@ def find_dir(*candidates: Path) -> Optional[Path]:
             return candidate
 
 
+class LazyCmdline:
+    """command line for log messages, only quoted if the message is emitted"""
+
+    def __init__(self, command: Iterable[Union[str, Path]]):
+        self.command = command
+
+    def __str__(self):
+        return subprocess.list2cmdline(self.command)
+
+
 def check_west_setup(zmk_app: Path):
-    try:
-        check_west_cmd = ["west", "--help", "build"]
-        logger.debug(f"run `{subprocess.list2cmdline(check_west_cmd)}`")
-        subprocess.check_call(
-            check_west_cmd,
-            cwd=zmk_app,
-            text=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-        return True
-    except subprocess.CalledProcessError:
-        return False
-    except FileNotFoundError:
-        return False
+    """look for the `.west/config` of a workspace containing `zmk_app`
+    (like west does to find its top directory) rather than running west,
+    and for the zephyr tree that `west update` fetches next to it, so that
+    an interrupted first update is picked up again"""
+    zmk_app = zmk_app.resolve()
+    for directory in (zmk_app, *zmk_app.parents):
+        if (directory / ".west" / "config").is_file():
+            return (directory / "zephyr" / "west.yml").is_file()
+    return False
 
 
 def run_west_setup(zmk_app: Path, dry_run: bool = False):
     west_init_cmd = ["west", "init", "-l", zmk_app]
     action = "would run" if dry_run else "run"
-    logger.debug(f"{action} `{subprocess.list2cmdline(west_init_cmd)}`")
+    logger.debug("%s `%s`", action, LazyCmdline(west_init_cmd))
     try:
         if not dry_run:
             subprocess.check_call(west_init_cmd, cwd=zmk_app, text=True)
@@ -131,11 +137,117 @@ def run_west_update(zmk_app: Path, dry_run: bool = False):
         ["west", "zephyr-export"],
     ]:
         action = "would run" if dry_run else "run"
-        logger.debug(f"{action} `{subprocess.list2cmdline(west_update_cmd)}`")
+        logger.debug("%s `%s`", action, LazyCmdline(west_update_cmd))
         if not dry_run:
             subprocess.check_call(west_update_cmd, cwd=zmk_app, text=True)
 
 
+def check_call_prefixed(
+    command: List[str],
+    prefix: str,
+    cwd: Optional[Path] = None,
+    env: Optional[Mapping[str, str]] = None,
+):
+    """like `subprocess.check_call` but prefix each line of output,
+    so concurrent commands can be told apart"""
+    with subprocess.Popen(
+        command,
+        cwd=cwd,
+        env=env,
+        text=True,
+        errors="replace",  # compiler output isn't guaranteed to be valid UTF-8
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    ) as process:
+        assert process.stdout
+        for line in process.stdout:
+            sys.stdout.write(f"{prefix}{line}")
+            sys.stdout.flush()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def inputs_digest(zmk_dir: Path, zmk_config: Optional[Path] = None) -> Optional[str]:
+    """hash of what all builds depend on: the ZMK revision, the revisions of the
+    west projects (zephyr, modules) and the contents of the zmk-config directory
+    (out-of-tree shields, boards, keymaps); `None` if the revisions cannot be
+    determined or ZMK or a west project has local changes"""
+    try:
+        revision = subprocess.check_output(
+            ["git", "-C", str(zmk_dir), "rev-parse", "HEAD"],
+            text=True,
+            stderr=subprocess.DEVNULL,
+        )
+        # `west update` can move projects pinned to branches without ZMK changing
+        west_projects = subprocess.check_output(
+            ["west", "list", "-f", "{abspath} {sha}"],
+            cwd=zmk_dir,
+            text=True,
+            stderr=subprocess.DEVNULL,
+        )
+        # the revisions don't cover uncommitted edits
+        project_dirs = (line.rsplit(" ", 1)[0] for line in west_projects.splitlines())
+        for project_dir in (zmk_dir, *project_dirs):
+            changes = subprocess.check_output(
+                ["git", "-C", str(project_dir), "status", "--porcelain"],
+                text=True,
+                stderr=subprocess.DEVNULL,
+            )
+            if changes.strip():
+                logger.debug(
+                    "`%s` has local changes, not reusing previous builds", project_dir
+                )
+                return None
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+    def parts():
+        yield revision.encode()
+        yield west_projects.encode()
+        if zmk_config:
+            for path in sorted(zmk_config.rglob("*")):
+                rel_path = path.relative_to(zmk_config)
+                if path.is_file() and ".git" not in rel_path.parts:
+                    yield str(rel_path).encode()
+                    yield path.read_bytes()
+
+    return digest(parts())
+
+
+def toolchain_id(build_dir: Path) -> Optional[str]:
+    """path, size and modification time of the C compiler a build directory is
+    configured with, so that a different Zephyr SDK or build image is noticed;
+    `None` if the build directory is not configured or the compiler is gone"""
+    try:
+        with open(build_dir / "CMakeCache.txt") as f:
+            for line in f:
+                if line.startswith("CMAKE_C_COMPILER:"):
+                    compiler = Path(line.partition("=")[2].strip())
+                    stat = compiler.stat()
+                    return f"{compiler} {stat.st_size} {stat.st_mtime_ns}"
+    except OSError:
+        pass
+    return None
+
+
+def inputs_fingerprint(
+    build_id: Iterable[str], toolchain_id: str, inputs_digest: str
+) -> str:
+    """hash of what a single build depends on: its arguments, its toolchain and
+    `inputs_digest`"""
+    parts = (*build_id, toolchain_id, inputs_digest)
+    return digest(part.encode() for part in parts)
+
+
+def digest(parts: Iterable[bytes]) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        # length-prefixed so that consecutive parts can't be confused
+        h.update(len(part).to_bytes(8, "little"))
+        h.update(part)
+    return h.hexdigest()
+
+
 def west_build_command(
     board: str,
     shield: Optional[Union[str, List[str]]] = None,
@@ -147,6 +259,17 @@ def west_build_command(
     extra_args: Optional[Iterable[str]] = None,
     extra_cmake_args: Optional[Iterable[str]] = None,
 ) -> List[str]:
+    def cmake_args() -> Iterator[str]:
+        shields = [shield] if isinstance(shield, str) else shield
+        if shields:
+            yield f"-DSHIELD={' '.join(shields)}"
+        if zmk_config:
+            yield f"-DZMK_CONFIG={zmk_config}"
+        if bin_name:
+            yield f'-DCONFIG_KERNEL_BIN_NAME="{bin_name}"'
+        if extra_cmake_args:
+            yield from extra_cmake_args
+
     def args() -> Iterator[str]:
         yield from ("-b", board)
 
@@ -159,21 +282,11 @@ def west_build_command(
         if extra_args:
             yield from extra_args
 
-        shields = [shield] if isinstance(shield, str) else shield
-        cmake_vals = {
-            "SHIELD": " ".join(shields) if shields else None,
-            "ZMK_CONFIG": zmk_config,
-            "CONFIG_KERNEL_BIN_NAME": f'"{bin_name}"' if bin_name else None,
-        }
-        cmake_args = [f"-D{name}={val}" for name, val in cmake_vals.items() if val]
-        if extra_cmake_args:
-            cmake_args += extra_cmake_args
-
-        if cmake_args:
-            yield from ("--", *cmake_args)
+        if cmake := list(cmake_args()):
+            yield from ("--", *cmake)
 
     return ["west", "build", *args()]
 
 
 def join(parts: Iterable[Optional[str]], sep: str) -> str:
-    return sep.join(filter(None, parts))
+    return sep.join(p for p in parts if p)
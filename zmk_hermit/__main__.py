@@ -4,11 +4,12 @@ import argparse
 import logging
 import os
 import re
+import stat
 import tempfile
 from dataclasses import dataclass
 from pathlib import Path
 from time import time
-from typing import Iterable, Iterator, Optional, Sequence
+from typing import Iterator, Optional, Sequence
 
 import zmk_build
 from zmk_build.argparse_helper import ArgparseMixin, arg
@@ -25,10 +26,15 @@ ZMKUSER = "zmkuser"
 ZMKUSER_HOME = Path("/home") / ZMKUSER
 ZMK_HOME = ZMKUSER_HOME / "zmk"
 ZMK_CONFIG = Path("/zmk-config")
+ZMK_CONFIG_BOARDS = ZMK_CONFIG / "boards"
+ZMK_CONFIG_SHIELDS = ZMK_CONFIG_BOARDS / "shields"
 ARTEFACTS = Path("/artefacts")
 BUILD = Path("/tmp/zmk-build")
+BUILD_TMPFS_OPTIONS = "exec,size=4g"
 DIR = Path(__file__).parent
 
+ZMK_GIT_SOURCE_RE = re.compile(r"([-_\w]+)(?::(.+))?$")
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -63,9 +69,12 @@ def run_build(
 ):
     volumes = Volumes()
 
+    into_path = Path(out_args.into).expanduser() if out_args.into else None
+    zmk_src_path = Path(zmk_args.zmk).expanduser() if zmk_args.zmk else None
+
     if kb_args.zmk_config:
         zmk_config_path = Path(kb_args.zmk_config).expanduser()
-        if zmk_config_path.is_dir():
+        if is_dir_mode(stat_mode(zmk_config_path)):
             volumes[ZMK_CONFIG] = zmk_config_path, "ro"
         else:
             raise ValueError("zmk-config must be a directory")
@@ -73,30 +82,29 @@ def run_build(
     shield_names: list[str] = []
     for shield in kb_args.shields:
         shield_path = Path(shield).expanduser()
-        if shield_path.is_file() or shield_path.is_dir():
+        shield_mode = stat_mode(shield_path)
+        if is_dir_mode(shield_mode) or is_file_mode(shield_mode):
             primary_shield_name = guess_shield_name(shield_path)
             logger.info(
                 f"guessed shield name `{primary_shield_name}` from `{shield_path}`"
             )
-            shield_dir = shield_path if shield_path.is_dir() else shield_path.parent
-            volumes[ZMK_CONFIG / "boards" / "shields" / primary_shield_name] = (
-                shield_dir,
-                "ro",
-            )
+            shield_dir = shield_path if is_dir_mode(shield_mode) else shield_path.parent
+            volumes[ZMK_CONFIG_SHIELDS / primary_shield_name] = shield_dir, "ro"
             shield_names.append(primary_shield_name)
         else:
             shield_names.append(str(shield))
 
     if kb_args.board:
         board_path = Path(kb_args.board).expanduser()
-        if board_path.is_dir():
+        board_mode = stat_mode(board_path)
+        if is_dir_mode(board_mode):
             board_name = guess_board_name(board_path)
             board_type = guess_board_type(board_path)
             logger.info(
                 f"guessed board name `{board_name}` ({board_type}) from `{board_path}`"
             )
-            volumes[ZMK_CONFIG / "boards" / board_type / board_name] = board_path, "ro"
-        elif board_path.is_file():
+            volumes[ZMK_CONFIG_BOARDS / board_type / board_name] = board_path, "ro"
+        elif is_file_mode(board_mode):
             raise ValueError("out-of-tree board must be a directory")
         else:
             board_name = str(kb_args.board)
@@ -107,7 +115,7 @@ def run_build(
 
     if kb_args.keymap:
         keymap_path = Path(kb_args.keymap).expanduser()
-        if keymap_path.is_file():
+        if is_file_mode(stat_mode(keymap_path)):
             keymap_name = keymap_path.stem
             tmp_name = primary_shield_name or board_name
             volumes[ZMK_CONFIG / f"{tmp_name}.keymap"] = keymap_path, "ro"
@@ -116,11 +124,12 @@ def run_build(
     else:
         keymap_name = None
 
-    output_basename = join([primary_shield_name, board_name, keymap_name], "-")
+    output_basename = "-".join(
+        p for p in (primary_shield_name, board_name, keymap_name) if p
+    )
 
-    if out_args.into:
-        into_path = Path(out_args.into).expanduser()
-        if into_path.is_dir():
+    if into_path:
+        if is_dir_mode(stat_mode(into_path)):
             volumes[ARTEFACTS] = into_path, "rw"
         else:
             raise ValueError("output directory not a directory")
@@ -133,7 +142,7 @@ def run_build(
         )
         shield_names.append(behavior_shield_name)
 
-        behavior_shield = ZMK_CONFIG / "boards" / "shields" / behavior_shield_name
+        behavior_shield = ZMK_CONFIG_SHIELDS / behavior_shield_name
 
         modular_behaviors_shield_files = ModularBehaviorsShieldFiles(
             map(Path, zmk_args.behaviors), behavior_shield
@@ -141,19 +150,24 @@ def run_build(
         for contents, path_in_shield in modular_behaviors_shield_files:
             volumes[path_in_shield] = contents, "ro"
 
+    tmpfs: dict[str, str] = {}
     if out_args.build_dir:
         build_path = Path(out_args.build_dir)
-        if build_path.is_dir():
+        if is_dir_mode(stat_mode(build_path)):
             volumes[BUILD] = build_path, "rw"
         else:
             raise ValueError("build directory not a directory")
+    else:
+        # build files don't outlive the container anyway, keep them in memory
+        # rather than in the container's copy-on-write layer
+        tmpfs[str(BUILD)] = BUILD_TMPFS_OPTIONS
 
     py_module_dir = Path(zmk_build.__file__).parent
     volumes[ZMKUSER_HOME / "py_zmk_build"] = py_module_dir, "ro"
     build_script = "python3", "-m", "py_zmk_build"
 
-    if zmk_args.zmk and Path(zmk_args.zmk).is_dir():
-        volumes[ZMK_HOME] = Path(zmk_args.zmk).expanduser(), "rw"
+    if zmk_src_path and is_dir_mode(stat_mode(zmk_src_path)):
+        volumes[ZMK_HOME] = zmk_src_path, "rw"
         dockerfile = DIR / "Dockerfile-local-src"
         image_args = docker_image_args(zmk_args.zmk_image)
     else:
@@ -186,16 +200,22 @@ def run_build(
         (*build_script, *build_py_ags()),
         volumes=volumes,
         tag="zmk-hermit",
+        base_image=zmk_args.zmk_image,
+        tmpfs=tmpfs,
     )
 
-    if not exit_code and out_args.into:
-        into_path = Path(out_args.into).expanduser()
-        for fn in into_path.glob(f"{output_basename}*.*"):
-            if (
-                fn.suffix.lstrip(".") in out_args.extensions
-                and fn.stat().st_mtime > start_time
-            ):
-                logger.info(f"retrieved `{out_args.into/ fn.name}`")
+    extensions = set(out_args.extensions)
+    if not exit_code and into_path and extensions:
+        with os.scandir(into_path) as entries:
+            for entry in entries:
+                stem, dot, ext = entry.name.rpartition(".")
+                if (
+                    dot
+                    and stem.startswith(output_basename)
+                    and ext in extensions
+                    and entry.stat().st_mtime > start_time
+                ):
+                    logger.info(f"retrieved `{out_args.into / entry.name}`")
 
     if modular_behaviors_shield_files:
         for temp_path in modular_behaviors_shield_files.temp_files:
@@ -302,9 +322,9 @@ class ZmkGitSource:
 
     @classmethod
     def Parse(cls, txt: str):
-        if m := re.match(r"([-_\w]+)(:(.+))?$", txt):
+        if m := ZMK_GIT_SOURCE_RE.match(txt):
             user = m.group(1)
-            branch = m.group(3) or "main"
+            branch = m.group(2) or "main"
             return cls(f"https://github.com/{user}/zmk.git", branch=branch)
         raise ValueError(txt)
 
@@ -325,8 +345,21 @@ def docker_image_args(
     yield "USER", ZMKUSER
 
 
-def join(parts: Iterable[Optional[str]], sep: str):
-    return sep.join(filter(None, parts))
+def stat_mode(path: Path) -> Optional[int]:
+    """`st_mode` of `path`, or `None` if it does not exist;
+    one `stat` call instead of an `is_file`/`is_dir` pair"""
+    try:
+        return path.stat().st_mode
+    except (OSError, ValueError):
+        return None
+
+
+def is_dir_mode(mode: Optional[int]):
+    return mode is not None and stat.S_ISDIR(mode)
+
+
+def is_file_mode(mode: Optional[int]):
+    return mode is not None and stat.S_ISREG(mode)
 
 
 if __name__ == "__main__":
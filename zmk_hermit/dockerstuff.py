@@ -1,3 +1,7 @@
+import atexit
+import functools
+import hashlib
+import io
 import json
 import logging
 import os
@@ -7,8 +11,6 @@ import sys
 from pathlib import Path
 from typing import Any, BinaryIO, Iterable, Literal, Mapping, Optional, Tuple, Union
 
-import docker
-
 logger = logging.getLogger(__name__)
 
 
@@ -19,6 +21,13 @@ DevicesMapping = dict[Path, Tuple[Path, DeviceMode]]
 
 PathLike = Union[Path, str]
 
+# bind-mount consistency hints for Docker Desktop's shared filesystem,
+# ignored on Linux: the host owns read-only sources, the container owns outputs
+VOLUME_CONSISTENCY: dict[VolumeMode, str] = {"ro": "cached", "rw": "delegated"}
+
+LINE_BREAK_RE = re.compile(rb"\n|\r(?!\n)")
+BUILD_STEP_RE = re.compile(r"^Step \d+/\d+ : ")
+
 class Volumes(VolumesMapping):
     def __setitem__(
         self,
@@ -32,6 +41,17 @@ class Volumes(VolumesMapping):
         super().__setitem__(Path(key), (Path(path), mode))
 
 
+@functools.cache
+def docker_client():
+    """client configured from the environment, shared for the whole process"""
+    # the docker SDK is slow to import and isn't needed for `--help` or bad arguments
+    import docker
+
+    client = docker.from_env()
+    atexit.register(client.close)
+    return client
+
+
 def run_in_container(
     dockerfile: Path,
     image_args: Iterable[Tuple[str, str]],
@@ -39,16 +59,54 @@ def run_in_container(
     volumes: Optional[VolumesMapping] = None,
     devices: Optional[DevicesMapping] = None,
     tag: Optional[str] = None,
+    base_image: Optional[str] = None,
     **extra_run_kwargs: Any,
 ):
-    client = docker.from_env()
+    client = docker_client()
+    from docker.errors import APIError, ImageNotFound
 
-    logger.debug("building image...")
-    image_id = build_docker_image(
-        open(dockerfile, "rb"),
-        buildargs=dict(image_args),
-        tag=tag,
-    )
+    dockerfile_bytes = dockerfile.read_bytes()
+    buildargs = dict(image_args)
+    image_id = None
+    labels = None
+    if tag:
+        # the base image is part of what the image is built from, but isn't
+        # in the Dockerfile or build args (eg. after a `docker pull`)
+        base_image_id = None
+        if base_image:
+            try:
+                base_image_id = client.images.get(base_image).id
+            except ImageNotFound:
+                logger.info(f"pulling `{base_image}`...")
+                base_image_id = client.images.pull(base_image).id
+
+        source = image_source(tag, buildargs)
+        labels = {f"{tag}.source": source}
+        tag = content_tag(tag, dockerfile_bytes, buildargs, base_image_id)
+        try:
+            image_id = client.images.get(tag).id
+            logger.debug(f"using existing image `{tag}`")
+        except ImageNotFound:
+            pass
+
+    if not image_id:
+        logger.debug("building image...")
+        image_id = build_docker_image(
+            io.BytesIO(dockerfile_bytes),
+            buildargs=buildargs,
+            tag=tag,
+            labels=labels,
+        )
+        # images built from the same arguments are superseded by the new one
+        for key, value in (labels or {}).items():
+            for image in client.images.list(filters={"label": f"{key}={value}"}):
+                for old_tag in image.tags:
+                    if old_tag != tag:
+                        try:
+                            client.images.remove(old_tag)
+                            logger.debug(f"removed superseded image `{old_tag}`")
+                        except APIError as e:
+                            logger.debug(f"could not remove `{old_tag}`: {e}")
 
     container_args = map(str, container_args)
 
@@ -63,7 +121,9 @@ def run_in_container(
     container = client.containers.run(
         image=image_id,
         command=list(map(str, container_args)),
-        volumes=format_path_mappings(volumes) if volumes else None,
+        volumes=(
+            format_path_mappings(volumes, VOLUME_CONSISTENCY) if volumes else None
+        ),
         devices=format_path_mappings(devices) if devices else None,
         user=os.getuid(),
         detach=True,
@@ -107,18 +167,50 @@ def resolve_mappings_overlaps(volumes: VolumesMapping):
     return volumes_copy
 
 
-def format_path_mappings(mapping: Mapping[Path, Tuple[Path, str]]):
+def format_path_mappings(
+    mapping: Mapping[Path, Tuple[Path, str]],
+    consistency: Optional[Mapping[str, str]] = None,
+):
+    def options(mode: str):
+        if consistency and mode in consistency:
+            return f"{mode},{consistency[mode]}"
+        return mode
+
     return [
-        f"{path.resolve()}:{bind.resolve()}:{mode}"
-        for bind, (path, mode) in mapping.items()
+        f"{path.resolve()}:{bind.resolve()}:{options(mode)}"
+        for bind, (path, mode) in sorted(mapping.items())
         if path.resolve().exists()
     ]
 
 
+def content_tag(
+    repository: str,
+    dockerfile: bytes,
+    buildargs: Mapping[str, str],
+    base_image_id: Optional[str] = None,
+):
+    """`repository:<hash>` tag that identifies an image by what it is built from"""
+    h = hashlib.blake2b(dockerfile, digest_size=8)
+    h.update(json.dumps(dict(buildargs), sort_keys=True).encode())
+    h.update((base_image_id or "").encode())
+    return f"{repository}:{h.hexdigest()}"
+
+
+def image_source(repository: str, buildargs: Mapping[str, str]):
+    """hash of the build arguments only, shared by the successive images built
+    from them as the Dockerfile or base image change"""
+    h = hashlib.blake2b(repository.encode(), digest_size=8)
+    h.update(json.dumps(dict(buildargs), sort_keys=True).encode())
+    return h.hexdigest()
+
+
 def build_docker_image(
-    dockerfile: BinaryIO, tag: Optional[str], buildargs: Mapping[str, str]
+    dockerfile: BinaryIO,
+    tag: Optional[str],
+    buildargs: Mapping[str, str],
+    labels: Optional[Mapping[str, str]] = None,
 ):
-    client = docker.APIClient()
+    client = docker_client().api
 
     image_id = None
 
@@ -129,11 +221,12 @@ def build_docker_image(
             buildargs=buildargs,
             rm=True,
             tag=tag,
+            labels=labels,
         ),
     ):
         if "stream" in data:
             for line in data["stream"].splitlines():
-                if line.startswith(" ---> ") or re.search(r"^Step \d+/\d+ : ", line):
+                if line.startswith(" ---> ") or BUILD_STEP_RE.match(line):
                     continue
                 if line.strip():
                     logger.debug(line)
@@ -156,13 +249,19 @@ def quote_stream(stream: Iterable[bytes]):
 def indent_stream(stream: Iterable[bytes], indent: bytes = b"| "):
     prev = b"\n"
     for chunk in stream:
-        for i in range(len(chunk)):
-            b = chunk[i : i + 1]
-            if prev == b"\r" and b != b"\n":
-                yield indent
-            elif prev == b"\n":
+        if not chunk:
+            continue
+        if prev == b"\n" or (prev == b"\r" and chunk[:1] != b"\n"):
+            yield indent
+        # indent after each line break within the chunk; a break at the very end
+        # is handled with the next chunk, once we know what follows it
+        start = 0
+        for m in LINE_BREAK_RE.finditer(chunk):
+            if m.end() < len(chunk):
+                yield chunk[start : m.end()]
                 yield indent
-            yield b
-            prev = b
+                start = m.end()
+        yield chunk[start:]
+        prev = chunk[-1:]
     if prev not in b"\n\r":
         yield b"\r"